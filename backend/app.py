@@ -1,12 +1,17 @@
 import os
 import json
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, current_app, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask_cors import CORS
+from sqlalchemy import insert, update
 from sqlalchemy.orm import joinedload
+from itsdangerous import URLSafeSerializer, BadSignature
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, create_refresh_token
 
@@ -30,7 +35,7 @@ ma = Marshmallow()
 # Initialize JWT
 jwt = JWTManager()
 
-def create_app():
+def create_app(config=None):
     app = Flask(__name__)
     CORS(app, resources={r"/api/*": {"origins": ["http://localhost:3000"], "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"]}})
 
@@ -39,6 +44,11 @@ def create_app():
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     app.config["JWT_SECRET_KEY"] = "mysecretkey"
     app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
+    # Signs the long-lived calendar feed URLs; kept separate so it can be rotated on its own
+    app.config["CALENDAR_FEED_SECRET_KEY"] = os.environ.get("CALENDAR_FEED_SECRET_KEY", "mycalendarsecretkey")
+    app.config["CALENDAR_FEED_CACHE_SIZE"] = 10000
+    if config:
+        app.config.update(config)
     
     jwt.init_app(app)
 
@@ -81,6 +91,7 @@ class User(db.Model):
     username = db.Column(db.String(150), unique=True, nullable=False)
     password_hash = db.Column(db.String(150), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+    calendar_feed_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     member = db.relationship('Member', uselist=False, back_populates='user', cascade="all, delete-orphan")
 
     def set_password(self, password):
@@ -167,6 +178,13 @@ def initialize_database():
         else:
             print("Tables already exist, skipping creation.")
 
+        # Databases created before calendar feeds were added lack this column
+        user_columns = [column['name'] for column in inspector.get_columns('user')]
+        if 'calendar_feed_version' not in user_columns:
+            logger.info("Adding calendar_feed_version column to user table...")
+            db.session.execute(db.text('ALTER TABLE "user" ADD COLUMN calendar_feed_version INTEGER NOT NULL DEFAULT 0'))
+            db.session.commit()
+
         logger.info("Initializing timetable...")
         initialize_timetable()
 
@@ -278,6 +296,128 @@ def update_timetable_json():
     with open('timetable.json', 'w') as f:
         json.dump(timetable_data, f, indent=2)
 
+# Calendar feed helpers
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+ICS_WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+
+# Rendered .ics feeds keyed by (user ID, feed key), least recently used first. The database
+# column User.calendar_feed_version decides whether an entry is still current, so a booking
+# made through any worker process invalidates every process's copy.
+calendar_feed_cache = OrderedDict()
+calendar_feed_cache_lock = threading.Lock()
+
+def calendar_token_serializer():
+    return URLSafeSerializer(current_app.config["CALENDAR_FEED_SECRET_KEY"], salt="calendar-feed")
+
+def calendar_feed_key(user):
+    # Ties the feed URL to this account: deleting the user, or changing their username or
+    # password, makes the old URL stop working even if the user ID is reused
+    return hashlib.sha256(f"{user.id}:{user.username}:{user.password_hash}".encode('utf-8')).hexdigest()[:16]
+
+def invalidate_calendar_feeds(user_ids):
+    # Call before committing so the version bump lands in the same transaction as the change
+    user_ids = {int(user_id) for user_id in user_ids}
+    if user_ids:
+        User.query.filter(User.id.in_(user_ids)).update(
+            {User.calendar_feed_version: User.calendar_feed_version + 1}, synchronize_session=False)
+
+def invalidate_calendar_feeds_for_class(class_id):
+    booked_user_ids = db.select(Booking.user_id) \
+        .join(Occurrence, Booking.occurrence_id == Occurrence.id) \
+        .where(Occurrence.gym_class_id == class_id)
+    User.query.filter(User.id.in_(booked_user_ids)).update(
+        {User.calendar_feed_version: User.calendar_feed_version + 1}, synchronize_session=False)
+
+def ics_escape(value):
+    return (value.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+def ics_fold(line):
+    # RFC 5545 limits content lines to 75 octets; continuation lines start with a space
+    parts = []
+    limit = 75
+    while len(line.encode('utf-8')) > limit:
+        cut = limit
+        while len(line[:cut].encode('utf-8')) > limit:
+            cut -= 1
+        parts.append(line[:cut])
+        line = line[cut:]
+        limit = 74
+    parts.append(line)
+    return '\r\n '.join(parts)
+
+def render_calendar_feed(user_id):
+    rows = db.session.query(Booking, Occurrence, GymClass) \
+        .join(Occurrence, Booking.occurrence_id == Occurrence.id) \
+        .join(GymClass, Occurrence.gym_class_id == GymClass.id) \
+        .filter(Booking.user_id == user_id) \
+        .order_by(Booking.id).all()
+
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//My Gym App//Class Bookings//EN",
+        "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:Gym Classes",
+    ]
+    for booking, occurrence, gym_class in rows:
+        try:
+            day_index = WEEKDAYS.index(occurrence.day.strip().lower())
+            hours, minutes = (int(part) for part in occurrence.time.split(':'))
+            # Occurrences repeat weekly, so start the series on the first matching day after booking
+            booked_on = booking.booking_date.date()
+            first_day = booked_on + timedelta(days=(day_index - booked_on.weekday()) % 7)
+            start = datetime(first_day.year, first_day.month, first_day.day, hours, minutes)
+        except ValueError:
+            logger.warning(f"Skipping booking {booking.id} in calendar feed: invalid day/time "
+                           f"'{occurrence.day}' '{occurrence.time}' for occurrence {occurrence.id}")
+            continue
+        end = start + timedelta(hours=1)
+        summary = gym_class.name
+        if gym_class.instructor:
+            summary = f"{summary} with {gym_class.instructor}"
+        lines.extend([
+            "BEGIN:VEVENT",
+            f"UID:booking-{booking.id}@gymtimetable",
+            f"DTSTAMP:{booking.booking_date.strftime('%Y%m%dT%H%M%SZ')}",
+            f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}",
+            f"DTEND:{end.strftime('%Y%m%dT%H%M%S')}",
+            f"RRULE:FREQ=WEEKLY;BYDAY={ICS_WEEKDAYS[day_index]}",
+            f"SUMMARY:{ics_escape(summary)}",
+            "END:VEVENT",
+        ])
+    lines.append("END:VCALENDAR")
+
+    return ('\r\n'.join(ics_fold(line) for line in lines) + '\r\n').encode('utf-8')
+
+def get_calendar_feed(user, feed_key):
+    cache_key = (user.id, feed_key)
+    version = user.calendar_feed_version
+    with calendar_feed_cache_lock:
+        cached = calendar_feed_cache.get(cache_key)
+        if cached and cached[0] == version:
+            calendar_feed_cache.move_to_end(cache_key)
+            return cached[1]
+
+    # The version was read before rendering and is bumped in the same transaction as any
+    # booking change, so the rendered body is never older than the version it is stored under
+    body = render_calendar_feed(user.id)
+    logger.info(f"Calendar feed rendered for user ID: {user.id}")
+    with calendar_feed_cache_lock:
+        calendar_feed_cache[cache_key] = (version, body)
+        calendar_feed_cache.move_to_end(cache_key)
+        while len(calendar_feed_cache) > current_app.config["CALENDAR_FEED_CACHE_SIZE"]:
+            calendar_feed_cache.popitem(last=False)
+    return body
+
+# Booking helpers
+# Largest number of classes a member can book in one batch request
+MAX_BATCH_BOOKINGS = 50
+
+def is_int_id(value):
+    # bool is a subclass of int, but true/false are never valid IDs
+    return isinstance(value, int) and not isinstance(value, bool)
+
 # Routes
 def register_routes(app):
     @app.route("/api/login", methods=["POST"])
@@ -347,6 +487,7 @@ def register_routes(app):
             occurrence.current_capacity += 1
             booking = Booking(user_id=current_user_id, occurrence_id=occurrence_id)
             db.session.add(booking)
+            invalidate_calendar_feeds([current_user_id])
             db.session.commit()
 
             logger.info(f"Class scheduled successfully for user ID: {current_user_id}, occurrence ID: {occurrence_id}")
@@ -360,6 +501,119 @@ def register_routes(app):
             logger.error(f"Error scheduling class: {str(e)}")
             return jsonify({"success": False, "message": f"Failed to schedule class: {str(e)}"}), 500
 
+    @app.route("/api/classes/schedule/batch", methods=["POST"])
+    @jwt_required()
+    def schedule_classes_batch():
+        try:
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict):
+                return jsonify({"success": False, "message": "Request body must be a JSON object"}), 400
+            current_user_id = get_jwt_identity()
+            atomic = data.get('atomic', False)
+            if not isinstance(atomic, bool):
+                return jsonify({"success": False, "message": "atomic must be true or false"}), 400
+
+            # Either an explicit list of occurrences or every weekly occurrence of a class
+            if 'gym_class_id' in data:
+                gym_class_id = data['gym_class_id']
+                if not is_int_id(gym_class_id):
+                    return jsonify({"success": False, "message": "gym_class_id must be an integer"}), 400
+                if not GymClass.query.get(gym_class_id):
+                    return jsonify({"success": False, "message": "Class not found"}), 404
+                occurrence_ids = [occ_id for (occ_id,) in db.session.query(Occurrence.id)
+                                  .filter_by(gym_class_id=gym_class_id)
+                                  .order_by(Occurrence.id).all()]
+            else:
+                occurrence_ids = data.get('occurrence_ids')
+                if not isinstance(occurrence_ids, list) or not all(is_int_id(occ_id) for occ_id in occurrence_ids):
+                    return jsonify({"success": False, "message": "occurrence_ids must be a list of integers"}), 400
+            if not occurrence_ids:
+                return jsonify({"success": False, "message": "No classes to schedule"}), 400
+            # Drop repeated IDs while keeping the order the client sent
+            occurrence_ids = list(dict.fromkeys(occurrence_ids))
+            if len(occurrence_ids) > MAX_BATCH_BOOKINGS:
+                return jsonify({"success": False, "message": f"Cannot schedule more than {MAX_BATCH_BOOKINGS} classes at once"}), 400
+
+            logger.info(f"Attempting to batch schedule {len(occurrence_ids)} classes for user {current_user_id}")
+
+            occurrences = {occ.id: occ for occ in Occurrence.query.filter(Occurrence.id.in_(occurrence_ids)).all()}
+            already_booked = {occ_id for (occ_id,) in db.session.query(Booking.occurrence_id).filter(
+                Booking.user_id == current_user_id,
+                Booking.occurrence_id.in_(occurrence_ids)
+            ).all()}
+
+            results = {}
+            to_book = []
+            for occurrence_id in occurrence_ids:
+                occurrence = occurrences.get(occurrence_id)
+                if not occurrence:
+                    results[occurrence_id] = {"occurrence_id": occurrence_id, "success": False, "message": "Class not found"}
+                elif occurrence_id in already_booked:
+                    results[occurrence_id] = {"occurrence_id": occurrence_id, "success": False, "message": "You have already booked this class"}
+                elif occurrence.current_capacity >= occurrence.max_capacity:
+                    results[occurrence_id] = {"occurrence_id": occurrence_id, "success": False, "message": "Class is full"}
+                else:
+                    to_book.append(occurrence_id)
+
+            claimed = {}
+            # Atomic mode skips the claim when a pre-check has already failed
+            claim_attempted = bool(to_book) and (not atomic or len(to_book) == len(occurrence_ids))
+            if claim_attempted:
+                # Claim a spot in every remaining occurrence with a single guarded UPDATE so a
+                # concurrent booking cannot push any of them past max_capacity
+                claimed = dict(db.session.execute(
+                    update(Occurrence)
+                    .where(Occurrence.id.in_(to_book), Occurrence.current_capacity < Occurrence.max_capacity)
+                    .values(current_capacity=Occurrence.current_capacity + 1)
+                    .returning(Occurrence.id, Occurrence.current_capacity),
+                    execution_options={"synchronize_session": False}
+                ).all())
+
+            for occurrence_id in to_book:
+                if occurrence_id in claimed:
+                    continue
+                if claim_attempted:
+                    # The guarded UPDATE skipped it, so another booking took the last spot
+                    results[occurrence_id] = {"occurrence_id": occurrence_id, "success": False, "message": "Class is full"}
+                else:
+                    results[occurrence_id] = {"occurrence_id": occurrence_id, "success": False,
+                                              "message": "Not booked because another class in the batch failed"}
+
+            if atomic and len(claimed) != len(occurrence_ids):
+                db.session.rollback()
+                logger.warning(f"Batch schedule rejected for user {current_user_id}: not every class could be booked")
+                for occurrence_id in claimed:
+                    results[occurrence_id] = {"occurrence_id": occurrence_id, "success": False,
+                                              "message": "Not booked because another class in the batch failed"}
+                return jsonify({
+                    "success": False,
+                    "message": "No classes were scheduled",
+                    "results": [results[occurrence_id] for occurrence_id in occurrence_ids]
+                }), 400
+
+            if claimed:
+                booking_date = datetime.now(timezone.utc)
+                db.session.execute(insert(Booking), [
+                    {"user_id": current_user_id, "occurrence_id": occurrence_id, "booking_date": booking_date}
+                    for occurrence_id in claimed
+                ])
+                invalidate_calendar_feeds([current_user_id])
+                db.session.commit()
+                for occurrence_id, current_capacity in claimed.items():
+                    results[occurrence_id] = {"occurrence_id": occurrence_id, "success": True,
+                                              "message": "Class scheduled successfully", "current_capacity": current_capacity}
+
+            logger.info(f"Batch scheduled {len(claimed)} of {len(occurrence_ids)} classes for user ID: {current_user_id}")
+            return jsonify({
+                "success": len(claimed) == len(occurrence_ids),
+                "message": f"Scheduled {len(claimed)} of {len(occurrence_ids)} classes",
+                "results": [results[occurrence_id] for occurrence_id in occurrence_ids]
+            }), 200
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error batch scheduling classes: {str(e)}")
+            return jsonify({"success": False, "message": f"Failed to schedule classes: {str(e)}"}), 500
+
     @app.route("/api/initialize", methods=["POST"])
     def initialize():
         try:
@@ -426,6 +680,38 @@ def register_routes(app):
             logger.error(f"Error fetching bookings: {str(e)}")
             return jsonify({"error": str(e)}), 422
     
+    @app.route("/api/calendar/feed-url", methods=["GET"])
+    @jwt_required()
+    def get_calendar_feed_url():
+        user = User.query.get(int(get_jwt_identity()))
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        token = calendar_token_serializer().dumps([user.id, calendar_feed_key(user)])
+        return jsonify({"url": url_for("calendar_feed", token=token, _external=True)}), 200
+
+    @app.route("/api/calendar/<token>.ics", methods=["GET"])
+    def calendar_feed(token):
+        # Calendar apps cannot send a JWT, so the feed URL carries a signed token instead
+        try:
+            user_id, feed_key = calendar_token_serializer().loads(token)
+            user = User.query.get(int(user_id))
+        except (BadSignature, TypeError, ValueError):
+            return jsonify({"error": "Calendar not found"}), 404
+        if not user or calendar_feed_key(user) != feed_key:
+            return jsonify({"error": "Calendar not found"}), 404
+
+        # Only the ETag is used for revalidation: the version changes on every invalidation,
+        # which a one-second Last-Modified timestamp cannot guarantee
+        etag = f"{feed_key}-{user.calendar_feed_version}"
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            response = app.response_class(get_calendar_feed(user, feed_key), mimetype="text/calendar")
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
     @app.route("/api/classes/cancel", methods=["POST"])
     @jwt_required()
     def cancel_class():
@@ -443,6 +729,7 @@ def register_routes(app):
             occurrence.current_capacity -= 1
             
             db.session.delete(booking)
+            invalidate_calendar_feeds([current_user_id])
             db.session.commit()
             
             return jsonify({
@@ -656,6 +943,7 @@ def register_routes(app):
             occurrence_to_remove = next(occ for occ in class_to_update.occurrences if occ.id == occ_id)
             db.session.delete(occurrence_to_remove)
 
+        invalidate_calendar_feeds_for_class(class_id)
         db.session.commit()
         update_timetable_json()
         return jsonify({"message": "Class updated successfully"}), 200
@@ -672,6 +960,7 @@ def register_routes(app):
         if not class_to_delete:
             return jsonify({"error": "Class not found"}), 404
 
+        invalidate_calendar_feeds_for_class(id)
         db.session.delete(class_to_delete)
         db.session.commit()
 
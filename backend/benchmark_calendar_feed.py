@@ -0,0 +1,92 @@
+"""Benchmark polling of the per-member iCalendar feeds.
+
+Calendar apps re-fetch subscribed feeds every few minutes, so this simulates
+thousands of members polling /api/calendar/<token>.ics and reports the time
+and number of SQL statements per poll for cold, cached and conditional (304)
+requests. Every poll still reads the member's row to check the feed token and
+calendar_feed_version, so cached polls cost one primary-key lookup. It uses an
+in-memory database and must be run from the backend folder so timetable.json
+can be found:
+
+    python benchmark_calendar_feed.py --members 5000
+"""
+import argparse
+import logging
+import time
+
+from sqlalchemy import event
+
+from app import (create_app, db, User, Booking, Occurrence, calendar_token_serializer,
+                 calendar_feed_key, invalidate_calendar_feeds)
+
+
+def seed_members(count, bookings_per_member):
+    occurrence_ids = [occ_id for (occ_id,) in db.session.query(Occurrence.id).order_by(Occurrence.id).all()]
+    users = [User(username=f"bench{i}", password_hash="x") for i in range(count)]
+    db.session.add_all(users)
+    db.session.flush()
+    db.session.add_all([
+        Booking(user_id=user.id, occurrence_id=occurrence_ids[(user.id + n) % len(occurrence_ids)])
+        for user in users for n in range(bookings_per_member)
+    ])
+    db.session.commit()
+    return users
+
+
+def poll(client, urls, etags=None):
+    statuses = {}
+    start = time.perf_counter()
+    for user_id, url in urls.items():
+        headers = {"If-None-Match": etags[user_id]} if etags else {}
+        response = client.get(url, headers=headers)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        if etags is None:
+            response.get_data()
+    return time.perf_counter() - start, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--bookings", type=int, default=3, help="bookings per member")
+    args = parser.parse_args()
+
+    # Keep the per-request log lines out of gym_app.log
+    logging.disable(logging.INFO)
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    client = app.test_client()
+
+    with app.app_context():
+        users = seed_members(args.members, args.bookings)
+        serializer = calendar_token_serializer()
+        urls = {user.id: f"/api/calendar/{serializer.dumps([user.id, calendar_feed_key(user)])}.ics"
+                for user in users}
+        user_ids = list(urls)
+
+        queries = [0]
+
+        @event.listens_for(db.engine, "before_cursor_execute")
+        def count_query(*_):
+            queries[0] += 1
+
+    def run(label, etags=None):
+        queries[0] = 0
+        elapsed, statuses = poll(client, urls, etags)
+        print(f"{label:<34} {elapsed * 1000 / len(urls):8.3f} ms/poll "
+              f"{queries[0] / len(urls):6.2f} queries/poll  {statuses}")
+
+    print(f"{args.members} members, {args.bookings} bookings each")
+    run("cold (render every feed)")
+    run("warm (served from cache)")
+    etags = {user_id: client.get(url).headers["ETag"] for user_id, url in urls.items()}
+    run("conditional (If-None-Match)", etags)
+
+    changed = user_ids[:len(user_ids) // 100 or 1]
+    with app.app_context():
+        invalidate_calendar_feeds(changed)
+        db.session.commit()
+    run(f"conditional, {len(changed)} feeds invalidated", etags)
+
+
+if __name__ == "__main__":
+    main()
@@ -63,6 +63,20 @@ const Bookings = () => {
     }
   };
 
+  const handleSubscribeCalendar = async () => {
+    try {
+      const token = localStorage.getItem('authToken');
+      const response = await axios.get(`${API_BASE_URL}/api/calendar/feed-url`, {
+        headers: { Authorization: `Bearer ${token}` }
+      });
+      await navigator.clipboard.writeText(response.data.url);
+      showSnackbar('Calendar link copied. Add it to your calendar app as a subscription.', 'success');
+    } catch (error) {
+      console.error('Error fetching calendar link:', error.response ? error.response.data : error.message);
+      showSnackbar('Failed to get calendar link. Please try again.', 'error');
+    }
+  };
+
   const handleDialogOpen = (booking) => {
     setSelectedBooking(booking);
     setIsDialogOpen(true);
@@ -88,6 +102,9 @@ const Bookings = () => {
   return (
     <Paper elevation={3} sx={{ p: 3, maxWidth: 600, mx: 'auto', mt: 4 }}>
       <Typography variant="h4" gutterBottom>My Bookings</Typography>
+      <Button variant="outlined" onClick={handleSubscribeCalendar} sx={{ mb: 2 }}>
+        Subscribe in Calendar
+      </Button>
       {bookings.length === 0 ? (
         <Typography>You have no bookings.</Typography>
       ) : (
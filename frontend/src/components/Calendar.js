@@ -21,6 +21,7 @@ import {
   ButtonGroup,
 } from '@mui/material';
 import axios from 'axios';
+import { API_BASE_URL } from '../config';
 import './CalendarStyles.css';
 
 const Calendar = ({ classes, selectedClass }) => {
@@ -217,6 +218,56 @@ const Calendar = ({ classes, selectedClass }) => {
     }
   };
 
+  const handleBookAllSessions = async () => {
+    if (selectedEvent) {
+      try {
+        const token = localStorage.getItem('authToken');
+        if (!token) {
+          setError('You are not authenticated. Please log in again.');
+          return;
+        }
+        const response = await axios.post(
+          `${API_BASE_URL}/api/classes/schedule/batch`,
+          { gym_class_id: selectedEvent.classItem.id },
+          { headers: { Authorization: `Bearer ${token}` } }
+        );
+        const capacities = {};
+        response.data.results.forEach((result) => {
+          if (result.current_capacity !== undefined) {
+            capacities[result.occurrence_id] = result.current_capacity;
+          }
+        });
+        setIsDialogOpen(false);
+        setConfirmationMessage(
+          `${response.data.message} for ${selectedEvent.classItem.name}`
+        );
+        setShowConfirmation(true);
+        const updatedEvents = events.map((event) => {
+          if (capacities[event.id] !== undefined) {
+            return {
+              ...event,
+              extendedProps: {
+                ...event.extendedProps,
+                occurrence: {
+                  ...event.extendedProps.occurrence,
+                  current_capacity: capacities[event.id],
+                },
+              },
+            };
+          }
+          return event;
+        });
+        setEvents(updatedEvents);
+      } catch (error) {
+        console.error('Error scheduling classes:', error);
+        setError(
+          error.response?.data?.message ||
+            'Failed to schedule classes. Please try again.'
+        );
+      }
+    }
+  };
+
   const CalendarToolbar = ({ calendarApi }) => {
     const handlePrev = () => {
       calendarApi.prev();
@@ -363,6 +414,7 @@ const Calendar = ({ classes, selectedClass }) => {
               <div className="dialog-actions">
                 <Button onClick={() => setIsDialogOpen(false)} className="dialog-button">Cancel</Button>
                 <Button onClick={handleScheduleClass} className="dialog-button">Schedule</Button>
+                <Button onClick={handleBookAllSessions} className="dialog-button">Book All Sessions of This Class</Button>
               </div>
             </>
           )}